@@ -7,6 +7,7 @@
 import torch
 import torch.nn.functional as F
 
+import utils
 import yolov3
 
 class ConvBnReLU(torch.nn.Module):
@@ -159,6 +160,18 @@ class DarkNet(torch.nn.Module):
         self.criterion = yolov3.YOLOv3Loss(num_classes, anchors, num_ids)
         
         self.__init_weights()
+        self._bn_weights = [m.weight for m in self.modules() if isinstance(m, torch.nn.BatchNorm2d)]
+    
+    def correct_bn_grad(self, lamb=0.01):
+        '''批归一化层缩放因子的L1稀疏化梯度修正.
+        
+        参数
+        ----
+        lamb : float
+            稀疏化因子.
+        '''
+        
+        utils.bn_l1_grad_(self._bn_weights, lamb)
     
     def __init_weights(self):
         for name, module in self.named_modules():
@@ -91,16 +91,13 @@ def get_transform(train, net_w=416, net_h=416):
 
 def collate_fn(batch, in_size=torch.IntTensor([416,416]), train=False):
     # transforms = get_transform(train, in_size[1].item(), in_size[0].item())
-    images, targets = [], []
-    for i,b in enumerate(batch):
-        # image, target = transforms(b[0], b[1])
-        image, target = b[0], b[1]
-        # image = image.type(torch.FloatTensor) / 255
-        target[:,0] = i
-        images.append(image)
-        targets.append(target)
-    # return torch.cat(tensors=images, dim=0), torch.cat(tensors=targets, dim=0)
-    return torch.stack(tensors=images, dim=0), torch.cat(tensors=targets, dim=0)
+    images, targets = zip(*batch)
+    # Fill image index of all targets at once after concatenation.
+    counts = torch.as_tensor([target.size(0) for target in targets])
+    targets = torch.cat(tensors=targets, dim=0)
+    targets[:,0] = torch.repeat_interleave(torch.arange(len(batch),
+        dtype=targets.dtype), counts)
+    return torch.stack(tensors=images, dim=0), targets
 
 class CustomDataset(object):
     def __init__(self, root, file='train', backbone='shufflenetv2'):
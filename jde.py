@@ -34,12 +34,15 @@ class JDEcoder(nn.Module):
         super(JDEcoder, self).__init__()
         self.im_size = im_size
         if anchor is not None:
-            self.anchor = torch.from_numpy(np.array(anchor, dtype=np.float32))
+            anchor = torch.from_numpy(np.array(anchor, dtype=np.float32))
         else:
-            self.anchor = torch.FloatTensor([
+            anchor = torch.FloatTensor([
                 [[85, 255], [120, 360], [170, 420], [340, 320]],
                 [[21, 64], [30, 90], [43, 128], [60, 180]],
                 [[6, 16], [8, 23], [11, 32], [16, 45]]])
+        # Registered as buffer so that it moves with the module to the
+        # training device once, instead of being copied every forward.
+        self.register_buffer('anchor', anchor, persistent=False)
         self.num_class = num_class
         self.embd_dim = embd_dim
         self.box_dim = 4
@@ -182,6 +185,12 @@ class JDELoss(JDEcoder):
         im_size:    Neural network input image size with format [height, width].
         classifier: Identify classifier.
         '''
+        # Loss is always computed in full precision, even under autocast.
+        with torch.autocast(device_type='cuda', enabled=False):
+            input = [inp.float() for inp in input]
+            return self._forward(input, target, im_size, classifier)
+    
+    def _forward(self, input, target, im_size, classifier):
         self.im_size = im_size
         loss_box, loss_cls, loss_ide = [], [], []
         for inp, anchor in zip(input, self.anchor):
@@ -235,14 +244,18 @@ class JDELoss(JDEcoder):
         loss = sum(loss)
         
         # Make up log information.
+        # Values are kept as detached device tensors instead of .item(), which
+        # removes the metric syncs only. The forward above still synchronizes
+        # on obj_mask.sum() > 0, ide.size(0) > 0 and the boolean mask indexing
+        # in _build_ground_truth. Convert them with float() when printing.
         metrics = {
-            'LBOX': sum([l.detach().cpu().item() for l in loss_box]),
-            'LCLS': sum([l.detach().cpu().item() for l in loss_cls]),
-            'LIDE': sum([l.detach().cpu().item() for l in loss_ide]),
-            'LOSS': loss.detach().cpu().item(),
-            'SBOX': self.s_box[0].detach().cpu().item(),
-            'SCLS': self.s_cls[0].detach().cpu().item(),
-            'SIDE': self.s_ide[0].detach().cpu().item()}
+            'LBOX': sum([l.detach().view(-1)[0] for l in loss_box]),
+            'LCLS': sum([l.detach().view(-1)[0] for l in loss_cls]),
+            'LIDE': sum([l.detach().view(-1)[0] for l in loss_ide]),
+            'LOSS': loss.detach().view(-1)[0],
+            'SBOX': self.s_box[0].detach(),
+            'SCLS': self.s_cls[0].detach(),
+            'SIDE': self.s_ide[0].detach()}
 
         return loss, metrics
     
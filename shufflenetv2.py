@@ -11,6 +11,7 @@ import torch.nn.functional as F
 
 import jde
 import iou
+import utils
 import yolov3
 
 class ShuffleNetV2Block(torch.nn.Module):
@@ -199,6 +200,10 @@ class ShuffleNetV2(torch.nn.Module):
         self.criterion = jde.JDELoss(num_ids, embd_dim=self.embedding_channels)  if num_ids > 0 else torch.nn.Sequential()
         
         self.__init_weights()
+        self._bn_weights = [m.weight for m in self.modules() if isinstance(m, torch.nn.BatchNorm2d)]
+    
+    def correct_bn_grad(self, lamb=0.01):
+        utils.bn_l1_grad_(self._bn_weights, lamb)
         
     def __init_weights(self):
         for name, module in self.named_modules():
@@ -5,15 +5,17 @@
 # date: 2020/4/20
 
 import os
+import sys
 import torch
+import copy
 import random
 import argparse
+import threading
+import contextlib
 import numpy as np
 import torch.utils.data
-from progressbar import *
 import multiprocessing as mp
 from functools import partial
-from collections import defaultdict
 
 import utils
 import yolov3
@@ -47,6 +49,8 @@ def parse_args():
         help='warmup iterations')
     parser.add_argument('--workers', type=int, default=4,
         help='number of data loading workers')
+    parser.add_argument('--prefetch-factor', type=int, default=2,
+        help='number of batches loaded in advance by each worker')
     parser.add_argument('--optim', type=str, default='sgd',
         help='optimization algorithms, adam or sgd')
     parser.add_argument('--lr', type=float, default=0.0001,
@@ -67,14 +71,22 @@ def parse_args():
         action='store_true')
     parser.add_argument('--lamb', type=float, default=0.01,
         help='sparsity factor')
-    parser.add_argument('--pin', help='use pin_memory',
-        action='store_true')
+    parser.add_argument('--pin', help='use pin_memory [default]',
+        action='store_true', default=True)
+    parser.add_argument('--no-pin', help='disable pin_memory',
+        dest='pin', action='store_false')
+    parser.add_argument('--amp', help='use mixed precision training [default]',
+        action='store_true', default=True)
+    parser.add_argument('--no-amp', help='disable mixed precision training',
+        dest='amp', action='store_false')
     parser.add_argument('--workspace', type=str, default='workspace',
         help='workspace path')
     parser.add_argument('--print-interval', type=int, default=40,
         help='log printing interval [40]')
     parser.add_argument('--seed', type=int, default=0,
         help='seed number')
+    parser.add_argument('--compile', help='compile network with torch.compile',
+        action='store_true')
     parser.add_argument('--freeze-bn', help='freeze batch norm',
         action='store_true')
     parser.add_argument('--backbone', type=str, default='darknet',
@@ -88,10 +100,59 @@ def init_seeds(seed=0):
     random.seed(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
-    torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed)
 
+def make_optimizer(optim, params, device, **kwargs):
+    '''Create optimizer with the fused CUDA kernel, or fall back to the
+    multi-tensor (foreach) implementation if fused is not supported.
+    '''
+    if device.type == 'cuda':
+        try:
+            return optim(params, fused=True, **kwargs)
+        except (TypeError, RuntimeError):
+            pass
+    return optim(params, foreach=True, **kwargs)
+
+def state_to_cpu(state):
+    '''Copy tensors in (nested) state dict to host memory, so the snapshot
+    can be saved in background while training updates the device tensors.
+    '''
+    if torch.is_tensor(state):
+        return state.detach().to('cpu', copy=True)
+    if isinstance(state, dict):
+        copied = type(state)((k, state_to_cpu(v)) for k, v in state.items())
+        # module state_dict versions, used by load_state_dict
+        if hasattr(state, '_metadata'):
+            copied._metadata = copy.deepcopy(state._metadata)
+        return copied
+    if isinstance(state, (list, tuple)):
+        return type(state)(state_to_cpu(v) for v in state)
+    return state
+
+def save_checkpoints(checkpoints, errors, verify=False):
+    '''Save checkpoints in writer thread. Exceptions are collected in errors,
+    and re-raised by the training thread after joining the writer. If verify
+    is True, every file is loaded back with weights_only=True, the default
+    of torch.load used when resuming.
+    '''
+    try:
+        for state, path in checkpoints:
+            torch.save(state, path)
+            if verify:
+                torch.load(path, weights_only=True)
+    except Exception as e:
+        errors.append(e)
+
+def join_saver(saver, errors):
+    if saver is not None:
+        saver.join()
+    if errors:
+        raise errors.pop()
+
 def train(args):    
+    torch.backends.cudnn.benchmark = True
+    torch.backends.cuda.matmul.allow_tf32 = True
+    
     utils.make_workspace_dirs(args.workspace)
     device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
     anchors = np.loadtxt(os.path.join(args.dataset, 'anchors.txt'))
@@ -100,14 +161,19 @@ def train(args):
     shared_size = torch.IntTensor(args.in_size).share_memory_()
     logger = utils.get_logger(path=os.path.join(args.workspace, 'log.txt'))
     
-    torch.backends.cudnn.benchmark = True
-    
     # dataset = ds.CustomDataset(args.dataset, 'train', args.backbone)
     dataset = ds.HotchpotchDataset('/data/tseng/dataset/jde', './data/train.txt', args.backbone)
     collate_fn = partial(ds.collate_fn, in_size=shared_size, train=True)
+    # keep workers alive across epochs, they still see the live shared_size.
+    # batches are pinned in the main process, the pinned host blocks are
+    # recycled by the CUDA caching host allocator.
+    loader_kwargs = {}
+    if args.workers > 0:
+        loader_kwargs = {'persistent_workers': True,
+            'prefetch_factor': args.prefetch_factor}
     data_loader = torch.utils.data.DataLoader(dataset, args.batch_size,
         True, num_workers=args.workers, collate_fn=collate_fn,
-        pin_memory=args.pin, drop_last=True)
+        pin_memory=args.pin, drop_last=True, **loader_kwargs)
 
     # num_ids = dataset.max_id + 2
     num_ids = int(dataset.max_id + 1)
@@ -122,13 +188,31 @@ def train(args):
         sys.exit(0)
     if args.checkpoint:
         model.load_state_dict(torch.load(args.checkpoint))    
+    model = model.to(memory_format=torch.channels_last)
+    amp = args.amp and device.type == 'cuda'
+    scaler = torch.amp.GradScaler('cuda', enabled=amp)
+    
+    # compile the network only, the loss builds targets with data dependent
+    # shapes. keep one graph per multi-scale input size instead of recompiling.
+    # the uncompiled model is kept for state_dict() and the optimizer.
+    forward = model
+    if args.compile:
+        model.criterion.forward = torch.compiler.disable(model.criterion.forward)
+        torch._dynamo.config.cache_size_limit = max(args.scale_step[2] + 1,
+            torch._dynamo.config.cache_size_limit)
+        forward = torch.compile(model, dynamic=False)
     
     params = [p for p in model.parameters() if p.requires_grad]
     if args.optim == 'sgd':
-        optimizer = torch.optim.SGD(params, lr=args.lr,
+        optimizer = make_optimizer(torch.optim.SGD, params, device, lr=args.lr,
             momentum=args.momentum, weight_decay=args.weight_decay)
     else:
-        optimizer = torch.optim.Adam(params, lr=args.lr, weight_decay=args.weight_decay)
+        optimizer = make_optimizer(torch.optim.Adam, params, device, lr=args.lr,
+            weight_decay=args.weight_decay)
+
+    logger.info('optimizer: {}, fused={}, foreach={}'.format(
+        type(optimizer).__name__, optimizer.defaults.get('fused'),
+        optimizer.defaults.get('foreach')))
 
     if args.freeze_bn:
         for name, param in model.named_parameters():
@@ -141,68 +225,120 @@ def train(args):
     trainer = f'{args.workspace}/checkpoint/trainer-ckpt.pth'
     if args.resume:
         trainer_state = torch.load(trainer)
+        # load_state_dict copies saved group options over the current ones,
+        # keep the implementation make_optimizer picked, old checkpoints
+        # would otherwise fall back to the per-parameter loop
+        for g in trainer_state['optimizer']['param_groups']:
+            for key in ('fused', 'foreach'):
+                if key in optimizer.defaults:
+                    g[key] = optimizer.defaults[key]
         optimizer.load_state_dict(trainer_state['optimizer'])
+        if 'scaler' in trainer_state:
+            scaler.load_state_dict(trainer_state['scaler'])
 
+    # warmup and step decay are both applied per batch by one scheduler
     if -1 in args.milestones:
-        args.milestones = [int(args.epochs * 0.5), int(args.epochs * 0.75)]
-    lr_scheduler = torch.optim.lr_scheduler.MultiStepLR(optimizer,
-        milestones=args.milestones, gamma=args.lr_gamma)
+        args.milestones = [int(args.epochs * 0.5) * len(data_loader),
+            int(args.epochs * 0.75) * len(data_loader)]
+    warmup = min(args.warmup, len(data_loader))
+    lr_table = utils.make_lr_table(args.epochs * len(data_loader), warmup,
+        args.milestones, args.lr_gamma)
+    # plain float, numpy scalars in param groups break weights_only loading
+    lr_factor = lambda iter: float(lr_table[min(iter, len(lr_table) - 1)])
+    lr_scheduler = torch.optim.lr_scheduler.LambdaLR(optimizer, lr_factor)
     
     start_epoch = 0
     if args.resume:
         start_epoch = trainer_state['epoch'] + 1
-        lr_scheduler.load_state_dict(trainer_state['lr_scheduler'])
+        if 'lr_lambdas' in trainer_state['lr_scheduler']:
+            lr_scheduler.load_state_dict(trainer_state['lr_scheduler'])
+        else:
+            # old checkpoint holds per-epoch MultiStepLR state, the scheduler
+            # now counts batches
+            lr_scheduler.last_epoch = start_epoch * len(data_loader)
+        # the scheduler applied the iteration 0 learning rate when it was
+        # created, restore the one for the resumed iteration
+        for g, base_lr in zip(optimizer.param_groups, lr_scheduler.base_lrs):
+            g['lr'] = base_lr * lr_factor(lr_scheduler.last_epoch)
 
     logger.info(args)
     logger.info('Start training from epoch {}'.format(start_epoch))
     model_path = f'{args.workspace}/checkpoint/{args.savename}-ckpt-%03d.pth'
     size = shared_size.numpy().tolist()
+    saver, save_errors = None, []
     
     for epoch in range(start_epoch, args.epochs):
         model.train()
+        # frozen batch norm layers use stored statistics, trainable ones
+        # keep batch statistics
+        for module in model.modules():
+            if isinstance(module, torch.nn.BatchNorm2d) and \
+                not module.weight.requires_grad:
+                module.eval()
         logger.info(('%8s%10s%10s' + '%10s' * 8) % (
             'Epoch', 'Batch', 'SIZE', 'LBOX', 'LCLS', 'LIDE', 'LOSS', 'SBOX', 'SCLS', 'SIDE', 'LR'))
 
-        rmetrics = defaultdict(float)
-        optimizer.zero_grad()
+        rmetrics = None
         for batch, (images, targets) in enumerate(data_loader):
-            warmup = min(args.warmup, len(data_loader))
-            if epoch == 0 and batch <= warmup:
-                lr = args.lr * (batch / warmup) ** 4
-                for g in optimizer.param_groups:
-                    g['lr'] = lr
+            # only allreduce gradients on the batch that updates weights
+            step = ((batch + 1) % args.accumulated_batches == 0) or (batch == len(data_loader) - 1)
+            sync = contextlib.nullcontext()
+            if not step and isinstance(model, torch.nn.parallel.DistributedDataParallel):
+                sync = model.no_sync()
         
-            loss, metrics = model(images.to(device), targets.to(device), size)
-            loss.backward()
-            
-            if args.sparsity:
-                model.correct_bn_grad(args.lamb)
+            images = images.to(device, non_blocking=True).contiguous(
+                memory_format=torch.channels_last)
+            targets = targets.to(device, non_blocking=True)
+            with sync:
+                with torch.autocast(device_type='cuda', enabled=amp):
+                    loss, metrics = forward(images, targets, size)
+                scaler.scale(loss / args.accumulated_batches).backward()
             
             num_batches = epoch * len(data_loader) + batch + 1
-            if ((batch + 1) % args.accumulated_batches == 0) or (batch == len(data_loader) - 1):
-                optimizer.step()
-                optimizer.zero_grad()
+            if step:
+                if args.sparsity:
+                    scaler.unscale_(optimizer)
+                    model.correct_bn_grad(args.lamb)
+                scaler.step(optimizer)
+                scaler.update()
+                optimizer.zero_grad(set_to_none=True)
 
-            for k, v in metrics.items():
-                rmetrics[k] = (rmetrics[k] * batch + metrics[k]) / (batch + 1)
+            # metrics stay on device and are copied to host only when logging.
+            # the loss forward still synchronizes on its mask checks and
+            # boolean mask indexing every batch.
+            if rmetrics is None:
+                rmetrics = torch.zeros(len(metrics), device=device)
+            rmetrics.mul_(batch).add_(torch.stack(list(metrics.values()))).div_(batch + 1)
             
-            fmt = tuple([('%g/%g') % (epoch, args.epochs), ('%g/%g') % (batch,
-                len(data_loader)), ('%gx%g') % (size[0], size[1])] + \
-                list(rmetrics.values()) + [optimizer.param_groups[0]['lr']])
             if batch % args.print_interval == 0:
-                logger.info(('%8s%10s%10s' + '%10.3g' * (len(rmetrics.values()) + 1)) % fmt)
+                fmt = tuple([('%g/%g') % (epoch, args.epochs), ('%g/%g') % (batch,
+                    len(data_loader)), ('%gx%g') % (size[0], size[1])] + \
+                    rmetrics.tolist() + [optimizer.param_groups[0]['lr']])
+                logger.info(('%8s%10s%10s' + '%10.3g' * (rmetrics.numel() + 1)) % fmt)
 
-            size = scale_sampler(num_batches)
-            shared_size[0], shared_size[1] = size[0], size[1]
+            # only touch the shared memory tensor when the size changes
+            new_size = scale_sampler(num_batches)
+            if new_size != size:
+                shared_size[0], shared_size[1] = new_size[0], new_size[1]
+            size = new_size
+            lr_scheduler.step()
       
-        torch.save(model.state_dict(), f"{model_path}" % epoch)
-        torch.save({'epoch' : epoch,
+        # write checkpoints in background, at most one writer at a time
+        join_saver(saver, save_errors)
+        checkpoints = [(state_to_cpu(model.state_dict()), f"{model_path}" % epoch),
+            (state_to_cpu({'epoch' : epoch,
             'optimizer' : optimizer.state_dict(),
-            'lr_scheduler' : lr_scheduler.state_dict()}, trainer)
+            'lr_scheduler' : lr_scheduler.state_dict(),
+            'scaler' : scaler.state_dict()}), trainer)]
+        # round-trip check the first checkpoints of the run
+        saver = threading.Thread(target=save_checkpoints,
+            args=(checkpoints, save_errors, saver is None))
+        saver.start()
         
         if epoch >= args.eval_epoch:
             pass
-        lr_scheduler.step()
+    
+    join_saver(saver, save_errors)
 
 if __name__ == '__main__':
     args = parse_args()
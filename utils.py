@@ -8,8 +8,11 @@ import os
 import re
 import cv2
 import copy
+import queue
 import torch
+import atexit
 import logging
+import logging.handlers
 import numpy as np
 
 def get_logger(name='root', path=None):
@@ -22,6 +25,13 @@ def get_logger(name='root', path=None):
     formatter = logging.Formatter(fmt='%(asctime)s [%(levelname)s]: %(message)s',
         datefmt='%Y-%m-%d %H:%M:%S')
     handler.setFormatter(formatter)
+    if path is not None:
+        # write log file in background thread, flushed at exit
+        records = queue.Queue(-1)
+        listener = logging.handlers.QueueListener(records, handler)
+        listener.start()
+        atexit.register(listener.stop)
+        handler = logging.handlers.QueueHandler(records)
     logger.addHandler(handler)
     return logger
 
@@ -73,6 +83,35 @@ def lr_lambda(iter, warmup, milestones, lr_gamma):
         factor *= pow(lr_gamma, int(iter > i))
     return factor
 
+def make_lr_table(num_iters, warmup, milestones, lr_gamma):
+    '''Precompute lr_lambda factors for iterations 0 to num_iters.
+    
+    Args:
+        num_iters: Total number of training iterations.
+        warmup: Warmup iterations.
+        milestones: List of iteration indices, in any order.
+        lr_gamma: Factor of decrease learning rate.
+    Returns:
+        Array of learning rate factors, indexed by iteration.
+    '''
+    iters = np.arange(num_iters + 1)
+    factors = np.power(lr_gamma, np.searchsorted(np.sort(milestones), iters))
+    return np.where(iters < warmup, (iters / max(warmup, 1)) ** 4, factors)
+
+def bn_l1_grad_(bn_weights, lamb=0.01):
+    '''Add the L1 sparsity regularization gradient lamb * sign(gamma) to
+    batch normalization scaling factors in place.
+    
+    Args:
+        bn_weights: List of batch normalization weights. Weights without
+            gradient are skipped.
+        lamb: Sparsity factor.
+    '''
+    weights = [w for w in bn_weights if w.grad is not None]
+    if weights:
+        torch._foreach_add_([w.grad for w in weights],
+            torch._foreach_sign(weights), alpha=lamb)
+
 def load_class_names(path):
     class_names = []
     with open(path, 'r') as file:
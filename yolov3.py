@@ -26,9 +26,11 @@ class YOLOv3SingleDecoder(torch.nn.Module):
             torch.cuda.is_available() else torch.FloatTensor
         self.in_size = in_size
         self.num_classes = num_classes
-        self.anchors = self.FloatTensor(anchors)
-        self.anchor_masks = self.LongTensor(((8,9,10,11),
-            (4,5,6,7),(0,1,2,3)))
+        # buffers follow the module across devices, no per-step copies
+        self.register_buffer('anchors', torch.as_tensor(anchors,
+            dtype=torch.float32).type(self.FloatTensor), persistent=False)
+        self.register_buffer('anchor_masks', self.LongTensor(((8,9,10,11),
+            (4,5,6,7),(0,1,2,3))), persistent=False)
         self.embd_dim = embd_dim
         
     def forward(self, xs):
@@ -140,6 +142,12 @@ class YOLOv3Loss(YOLOv3SingleDecoder):
             in_size: input size. in_size=(height, width)
         '''
         
+        # compute losses in full precision even under autocast
+        with torch.autocast(device_type='cuda', enabled=False):
+            xs = [x.float() for x in xs]
+            return self._forward(xs, targets, in_size, classifier)
+    
+    def _forward(self, xs, targets, in_size, classifier):
         # update input size
         self.in_size = in_size
 
@@ -184,12 +192,12 @@ class YOLOv3Loss(YOLOv3SingleDecoder):
         loss = sum(loss)
         
         # just for log        
-        metrics = {'LBOX':0, 'LCLA':0, 'LIDE':0, 'LOSS':loss.detach().cpu().item(),
-            'SB':self.sbs[0].item(), 'SC':self.scs[0].item(), 'SI':self.sis[0].item()}
+        metrics = {'LBOX':0, 'LCLA':0, 'LIDE':0, 'LOSS':loss.detach().view(-1)[0],
+            'SB':self.sbs[0].detach(), 'SC':self.scs[0].detach(), 'SI':self.sis[0].detach()}
         for lb, lc, li in zip(lbboxes, lclasss, lidents):
-            metrics['LBOX'] += lb.detach().cpu().item()
-            metrics['LCLA'] += lc.detach().cpu().item()
-            metrics['LIDE'] += li.detach().cpu().item()
+            metrics['LBOX'] += lb.detach().view(-1)[0]
+            metrics['LCLA'] += lc.detach().view(-1)[0]
+            metrics['LIDE'] += li.detach().view(-1)[0]
         
         return loss, metrics
     